@@ -2,9 +2,14 @@ import streamlit as st
 import os
 import time
 import uuid
-import pandas as pd
-import google.generativeai as genai  # ✅ 올바른 import 수정됨
-from google.api_core import exceptions as google_exceptions
+import atexit
+import threading
+import weakref
+import io
+import csv
+import json
+import hashlib
+from collections import OrderedDict, deque
 
 # --- 상수 및 설정 ---
 
@@ -15,34 +20,147 @@ if 'session_id' not in st.session_state:
 
 # 사용 가능한 모델 목록
 AVAILABLE_MODELS = [
+    "gemini-1.5-flash-8b",
     "gemini-1.5-flash",
     "gemini-1.5-pro",
 ]
 
+# 길거나 까다로운 문의는 상위 모델로 라우팅
+ESCALATION_MODEL = "gemini-1.5-pro"
+ESCALATION_PROMPT_LENGTH = 500
+ESCALATION_KEYWORDS = ("환불",)
+
+# 역할별 아바타
+AVATARS = {"user": "👤", "model": "🤖"}
+
 # 시스템 프롬프트
-SYSTEM_PROMPT = """
-당신은 쇼핑몰 구매 과정에서 불편을 겪은 고객을 응대하는 매우 전문적이고 친절한 고객 응대 챗봇입니다.
-다음 규칙을 엄격히 준수하여 응답해야 합니다:
+SYSTEM_PROMPT = """쇼핑몰 구매 불편을 겪은 고객을 응대하는 친절한 상담 챗봇. 규칙:
+- 고객 감정에 공감하며 정중한 존댓말 사용
+- 불편 사항을 구체적으로 정리해 담당자에게 전달됨을 안내
+- 회신용 이메일 주소 요청
+- 이메일 제공 거부 시 정중히 안내 후 대화 종료"""
+
+# 대화 기록(JSONL) 저장 디렉터리
+LOG_DIR = ".logs"
+
+# 로그 쓰기 버퍼 크기와 강제 flush 주기(기록 수)
+LOG_BUFFER_SIZE = 65536
+LOG_FLUSH_INTERVAL = 16
+
+# 동시에 열어 둘 세션 로그 파일 핸들 수의 상한
+LOG_OPEN_FILES_MAX = 64
+
+# 대화 기록 CSV 컬럼
+LOG_FIELDS = ["session_id", "timestamp", "model", "user_message", "bot_response"]
+
+# 맥락으로 보낼 대화 기록의 최대 토큰 수 (현재 질문 포함)
+MAX_CONTEXT_TOKENS = 2000
+
+# 토큰 예산과 별개로, 맥락 후보로 보관할 최근 메시지 수의 상한
+MAX_CONTEXT_MESSAGES = 20
+
+# 화면에 한 번에 표시할 메시지 수 ("이전 메시지 더 보기"마다 이만큼 늘어남)
+DISPLAY_PAGE_SIZE = 50
+
+# 429 재시도 시 한 번에 기다릴 최대 시간(초)
+MAX_RETRY_DELAY = 30
 
-1. **태도:** 사용자는 쇼핑몰 구매 과정에서 겪은 불편/불만을 언급합니다. 이들의 감정에 공감하고 정중한 존댓말로 응답하세요.
-2. **정보 수집 및 안내:** 사용자가 언급한 불편 사항을 구체적으로 정리하여 담당자에게 전달된다고 안내하세요.
-3. **연락처 요청:** 담당자 회신을 위해 이메일 주소를 요청하세요.
-4. **연락처 거부 처리:** 사용자가 이메일 제공을 거부하면 정중하게 안내하고 대화를 종료하세요.
-"""
+# 생성 설정. 같은 요청에 같은 응답을 돌려주는 응답 캐시가 의미 있도록 샘플링을 끔
+GENERATION_CONFIG = {"temperature": 0}
+
+# 동시에 유지할 API 키별 클라이언트(gRPC 연결) 수의 상한
+GEMINI_CLIENTS_MAX = 16
+
+# 응답 캐시에 보관할 최대 항목 수
+RESPONSE_CACHE_SIZE = 256
 
 # --- 세션 상태 초기화 ---
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
-if "log_records" not in st.session_state:
-    st.session_state.log_records = []
+if "api_history" not in st.session_state:
+    # API 형식으로 미리 변환해 둔 최근 메시지와 그 토큰 수 (매 요청마다 다시 만들거나 세지 않기 위함)
+    st.session_state.api_history = deque(maxlen=MAX_CONTEXT_MESSAGES)
+if "display_limit" not in st.session_state:
+    st.session_state.display_limit = DISPLAY_PAGE_SIZE
+if "log_count" not in st.session_state:
+    # 기록 자체는 디스크(JSONL)에 두고, 메모리에는 개수만 보관
+    st.session_state.log_count = 0
 if "logging_enabled" not in st.session_state:
     st.session_state.logging_enabled = True
 
+# --- 로그 내보내기 ---
+def get_log_path():
+    return os.path.join(LOG_DIR, f"{st.session_state.session_id}.jsonl")
+
+
+@st.cache_resource
+def get_open_log_files():
+    """열려 있는 로그 핸들 목록. 프로세스 종료 시 남은 버퍼를 한 번에 flush합니다."""
+    files = weakref.WeakSet()
+
+    def flush_all():
+        for f in list(files):
+            if not f.closed:
+                f.flush()
+
+    atexit.register(flush_all)
+    return files
+
+
+@st.cache_resource(max_entries=LOG_OPEN_FILES_MAX)
+def get_log_file(path):
+    """로그 파일을 한 번만 열어 버퍼링된 핸들을 재사용합니다.
+    캐시에서 밀려난(오래 쓰이지 않은 세션의) 핸들은 참조가 사라지면 닫히면서 flush됩니다."""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    f = open(path, "a", encoding="utf-8", buffering=LOG_BUFFER_SIZE)
+    get_open_log_files().add(f)
+    return f
+
+
+def iter_log_records():
+    """세션의 JSONL 기록을 한 줄씩 읽어 dict로 내보냅니다."""
+    get_log_file(get_log_path()).flush()
+    with open(get_log_path(), encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def iter_csv(records):
+    """대화 기록을 한 줄씩 CSV 문자열로 내보냅니다. (전체를 한 번에 버퍼링하지 않음)"""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=LOG_FIELDS)
+    writer.writeheader()
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    for record in records:
+        writer.writerow(record)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+@st.fragment
+def render_log_download():
+    """내보내기·다운로드 버튼 클릭 시 앱 전체가 아닌 이 영역만 다시 실행되도록 fragment로 분리합니다."""
+    if not st.session_state.log_count:
+        return
+    # CSV는 사용자가 내보내기를 요청했을 때만 만들고, 세션 상태에는 보관하지 않음
+    if st.button("📄 대화 기록 내보내기 준비", help="누를 때마다 현재까지의 기록으로 CSV를 새로 만듭니다."):
+        st.download_button(
+            label="⬇️ 대화 기록 다운로드 (CSV)",
+            data="".join(iter_csv(iter_log_records())).encode("utf-8"),
+            file_name=f"chat_log_{st.session_state.session_id}.csv",
+            mime="text/csv"
+        )
+        st.caption("다운로드 후 버튼이 사라지며, 다시 받으려면 '내보내기 준비'를 한 번 더 눌러 주세요.")
+
+
 # --- Streamlit 페이지 설정 ---
 st.set_page_config(
     page_title="Gemini 고객 불편 접수 챗봇",
     layout="wide",
-    initial_sidebar_state="expanded"
+    initial_sidebar_state="collapsed"
 )
 
 st.title("🛍️ Gemini 고객 불편 접수 챗봇")
@@ -56,21 +174,233 @@ with st.sidebar:
     api_key = st.text_input("🔑 Gemini API Key", type="password", placeholder="여기에 API 키를 입력하세요")
     if not api_key:
         st.warning("Gemini API 키를 입력해야 챗봇을 사용할 수 있습니다.")
-    else:
-        genai.configure(api_key=api_key)
 
     # 모델 선택
     selected_model = st.selectbox("모델 선택", AVAILABLE_MODELS, index=0)
 
     # 로그 다운로드
-    if st.session_state.log_records:
-        log_df = pd.DataFrame(st.session_state.log_records)
-        st.download_button(
-            label="⬇️ 대화 기록 다운로드 (CSV)",
-            data=log_df.to_csv(index=False).encode("utf-8"),
-            file_name=f"chat_log_{st.session_state.session_id}.csv",
-            mime="text/csv"
-        )
+    render_log_download()
 
     if st.button("🔄 대화 초기화"):
-        st.session_state.chat_history.c
+        # 대화 기록 로그(JSONL)는 남겨 두고 화면·맥락만 초기화
+        st.session_state.chat_history.clear()
+        st.session_state.api_history.clear()
+        st.session_state.display_limit = DISPLAY_PAGE_SIZE
+        st.rerun()
+
+# --- Gemini 응답 생성 ---
+@st.cache_resource
+def get_response_cache():
+    """세션과 재실행을 넘어 공유되는 응답 캐시 (요청 해시 -> 응답 텍스트)와 그 잠금.
+    여러 세션의 스크립트 스레드가 동시에 접근하므로 항상 잠금을 잡고 사용합니다."""
+    return OrderedDict(), threading.Lock()
+
+
+def build_cache_key(api_key, model_name, history, user_prompt):
+    """(키, 모델, 생성 설정, 전체 대화 기록, 질문)으로 요청을 식별합니다. 맥락 자르기는 이 값들로 결정되므로
+    자르기 전에 조회할 수 있습니다. API 키별로 분리하여 다른 키로 받은 응답은 공유하지 않습니다."""
+    api_key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    payload = json.dumps(
+        [api_key_hash, model_name, SYSTEM_PROMPT, GENERATION_CONFIG, history, user_prompt],
+        ensure_ascii=False, sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@st.cache_resource(max_entries=GEMINI_CLIENTS_MAX)
+def get_generative_client(api_key):
+    """API 키별 GenerativeService 클라이언트. 재실행 간에 재사용하여 gRPC 연결을 유지합니다.
+    캐시에서 밀려난 클라이언트는 참조가 사라지면 연결과 함께 정리됩니다."""
+    from google.ai import generativelanguage as glm
+
+    return glm.GenerativeServiceClient(client_options={"api_key": api_key})
+
+
+@st.cache_resource(max_entries=GEMINI_CLIENTS_MAX * len(AVAILABLE_MODELS))
+def get_gemini_model(api_key, model_name, system_instruction=None):
+    """API 키·모델별로 한 번만 생성하여 재실행 간에 재사용합니다."""
+    # 무거운 SDK import는 첫 화면 이후, 실제로 모델이 필요할 때로 미룸
+    import google.generativeai as genai
+
+    # genai.configure()는 프로세스 전역 상태라 다른 세션이 호출하면 키가 뒤섞일 수 있으므로,
+    # 전역 설정 대신 이 키로 만든 클라이언트를 모델에 직접 연결.
+    # _client는 비공개 속성으로, google-generativeai==0.8.3(requirements.txt 고정 버전)의
+    # generate_content/count_tokens가 `self._client is None`일 때만 전역 클라이언트를 가져오는 동작에 의존함.
+    # SDK 버전을 올릴 때는 이 부분을 다시 확인해야 함.
+    model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+    model._client = get_generative_client(api_key)
+    return model
+
+
+def get_retry_delay(error, default):
+    """서버가 알려준 재시도 대기 시간(RetryInfo 또는 Retry-After 헤더)을 우선 사용합니다.
+    값이 없거나 0이면 default를, 너무 길면 MAX_RETRY_DELAY를 사용합니다."""
+    delay = default
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            delay = retry_delay.seconds + retry_delay.nanos / 1e9
+            break
+    else:
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        retry_after = headers.get("retry-after", "")
+        if retry_after.isdigit():
+            delay = int(retry_after)
+    return min(max(delay, default), MAX_RETRY_DELAY)
+
+
+def estimate_tokens(text):
+    """API 호출 없이 보수적으로 추정한 토큰 수 (한글은 대략 글자당 1토큰 이하)."""
+    return len(text)
+
+
+def route_model(user_prompt):
+    """기본은 사이드바에서 선택한 모델, 길거나 까다로운 문의만 상위 모델을 사용합니다."""
+    if len(user_prompt) > ESCALATION_PROMPT_LENGTH or any(k in user_prompt for k in ESCALATION_KEYWORDS):
+        return ESCALATION_MODEL
+    return selected_model
+
+
+def get_response(user_prompt, model_name, placeholder):
+    """최근 대화 맥락과 함께 Gemini에 질의하고, 응답을 스트리밍으로 placeholder에 렌더링합니다.
+    (응답 텍스트, 응답 토큰 수)를 반환합니다."""
+    from google.api_core import exceptions as google_exceptions
+
+    # 동일한 요청이 이미 처리된 적 있다면 API를 호출하지 않고 바로 반환
+    cache, cache_lock = get_response_cache()
+    cache_key = build_cache_key(api_key, model_name, [message for message, _ in st.session_state.api_history], user_prompt)
+    with cache_lock:
+        cached_text = cache.get(cache_key)
+        if cached_text is not None:
+            cache.move_to_end(cache_key)
+    if cached_text is not None:
+        placeholder.markdown(cached_text)
+        return cached_text, estimate_tokens(cached_text)
+
+    # 최신 메시지부터 거슬러 올라가며 토큰 예산 안에 드는 대화만 맥락으로 사용
+    # (토큰 수는 메시지를 기록할 때 함께 저장해 두므로 여기서는 API를 호출하지 않음)
+    budget = MAX_CONTEXT_TOKENS - estimate_tokens(user_prompt)
+    context_history = []
+    for message, n_tokens in reversed(st.session_state.api_history):
+        budget -= n_tokens
+        if budget < 0:
+            break
+        context_history.append(message)
+    context_history.reverse()
+    # 맥락은 사용자 메시지로 시작해야 하므로 앞쪽의 모델 응답은 버림
+    if context_history and context_history[0]["role"] == "model":
+        context_history.pop(0)
+    context_history.append({"role": "user", "parts": [user_prompt]})
+
+    model = get_gemini_model(api_key, model_name, SYSTEM_PROMPT)
+
+    # 429(요청 한도 초과) 시 지수 백오프로 재시도
+    max_retries = 3
+    retry_delay = 2
+    for attempt in range(max_retries):
+        try:
+            stream = model.generate_content(context_history, generation_config=GENERATION_CONFIG, stream=True)
+            break
+        except google_exceptions.ResourceExhausted as e:
+            if attempt == max_retries - 1:
+                raise
+            delay = get_retry_delay(e, retry_delay)
+            with st.spinner(f"요청이 많아 {delay:.0f}초 후 다시 시도합니다..."):
+                time.sleep(delay)
+            retry_delay *= 2
+
+    buf = []
+    response_tokens = None
+    try:
+        for chunk in stream:
+            buf.append(chunk.text)
+            placeholder.markdown("".join(buf))
+            # 마지막 조각의 usage_metadata에 응답 전체의 토큰 수가 담겨 옴
+            usage = getattr(chunk, "usage_metadata", None)
+            if usage and usage.candidates_token_count:
+                response_tokens = usage.candidates_token_count
+    except (google_exceptions.GoogleAPIError, ValueError):
+        # 스트리밍 도중 오류가 나면 이미 받은 부분 응답이라도 살립니다.
+        if not buf:
+            raise
+        placeholder.markdown("".join(buf))
+        st.warning("응답 수신 중 오류가 발생하여 일부만 표시되었습니다.")
+        partial_text = "".join(buf)
+        return partial_text, estimate_tokens(partial_text)
+
+    # 온전히 받은 응답만 캐시에 저장
+    response_text = "".join(buf)
+    if response_tokens is None:
+        response_tokens = estimate_tokens(response_text)
+    with cache_lock:
+        cache[cache_key] = response_text
+        if len(cache) > RESPONSE_CACHE_SIZE:
+            cache.popitem(last=False)
+    return response_text, response_tokens
+
+
+def log_conversation(user_message, bot_response, model_name):
+    if not st.session_state.logging_enabled:
+        return
+    record = {
+        "session_id": st.session_state.session_id,
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "model": model_name,
+        "user_message": user_message,
+        "bot_response": bot_response,
+    }
+    f = get_log_file(get_log_path())
+    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    st.session_state.log_count += 1
+    if st.session_state.log_count % LOG_FLUSH_INTERVAL == 0:
+        f.flush()
+
+
+# --- 대화 화면 ---
+def show_older_messages():
+    st.session_state.display_limit += DISPLAY_PAGE_SIZE
+
+
+@st.fragment
+def render_conversation():
+    """대화 기록 렌더링. "이전 메시지 더 보기"를 눌러도 이 영역만 다시 실행됩니다."""
+    # 최근 메시지만 렌더링하여 긴 세션에서도 재실행 비용을 일정하게 유지
+    hidden_count = len(st.session_state.chat_history) - st.session_state.display_limit
+    if hidden_count > 0:
+        st.button(f"⬆️ 이전 메시지 더 보기 ({hidden_count}개)", on_click=show_older_messages)
+
+    for role, text in st.session_state.chat_history[-st.session_state.display_limit:]:
+        with st.chat_message(role, avatar=AVATARS[role]):
+            st.markdown(text)
+
+
+if not api_key:
+    st.info("왼쪽 사이드바를 열어 Gemini API 키를 입력해 주세요.")
+
+render_conversation()
+
+if prompt := st.chat_input("불편하셨던 점을 말씀해 주세요", disabled=not api_key):
+    # google.api_core.exceptions는 grpc를 함께 불러오므로 첫 화면 이후로 import를 미룸
+    from google.api_core import exceptions as google_exceptions
+
+    with st.chat_message("user", avatar=AVATARS["user"]):
+        st.markdown(prompt)
+
+    model_name = route_model(prompt)
+    with st.chat_message("model", avatar=AVATARS["model"]):
+        placeholder = st.empty()
+        try:
+            response_text, response_tokens = get_response(prompt, model_name, placeholder)
+        except google_exceptions.GoogleAPIError as e:
+            st.error(f"Gemini API 호출 중 오류가 발생했습니다: {e}")
+            st.stop()
+        except ValueError:
+            # 안전 정책 등으로 응답 후보가 차단되어 텍스트가 없는 경우 (chunk.text가 ValueError를 발생)
+            st.error("응답이 차단되었거나 비어 있어 표시할 수 없습니다. 표현을 바꿔 다시 말씀해 주세요.")
+            st.stop()
+
+    st.session_state.chat_history.append(("user", prompt))
+    st.session_state.chat_history.append(("model", response_text))
+    st.session_state.api_history.append(({"role": "user", "parts": [prompt]}, estimate_tokens(prompt)))
+    st.session_state.api_history.append(({"role": "model", "parts": [response_text]}, response_tokens))
+    log_conversation(prompt, response_text, model_name)